@@ -1,98 +1,790 @@
+import copy
+import gzip
+import hashlib
+import io
+import mimetypes
 import os
-from flask import Flask, request, send_file, render_template_string
-import yt_dlp
+import queue
+import re
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from types import MappingProxyType
+from urllib.parse import quote
+from cachetools import TTLCache
+import requests
+from flask import Flask, Response, abort, request, send_file, stream_with_context
+import yt_dlp
 
 app = Flask(__name__)
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+
+CHUNK_SIZE = 64 * 1024
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 10 * 1024 ** 3))
+STALE_PART_SECONDS = 3600
+# Hand cache hits to a front-end server so it can sendfile(2) them: set
+# X_ACCEL_PREFIX to an nginx `internal` location aliased to CACHE_DIR, or
+# USE_X_SENDFILE=1 behind Apache/lighttpd.
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX")
+MIMETYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg", "ogg": "audio/ogg", "mp4": "video/mp4"}
+BATCH_MAX_URLS = 50
+BATCH_CONCURRENCY = 4
+PROBE_POOL_SIZE = 4
+
+_info_cache = TTLCache(maxsize=512, ttl=600)
+_info_cache_lock = threading.Lock()
+
+EXECUTOR = ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) * 2))
+JOBS = TTLCache(maxsize=4096, ttl=3600)
+_inflight = {}
+_jobs_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+
+def prepare_cache_dir():
+    # An explicit CACHE_DIR has to work; the default falls back to the temp
+    # dir so the app still starts for a user who cannot write /var/cache.
+    configured = os.environ.get("CACHE_DIR")
+    if configured:
+        candidates = [configured]
+    else:
+        candidates = ["/var/cache/ytdl", os.path.join(tempfile.gettempdir(), "ytdl-cache")]
+    for path in candidates:
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(path, os.W_OK):
+            return path
+    raise RuntimeError(f"Cache directory {candidates[0]} is not writable; set CACHE_DIR")
+
+
+def remove_stale_parts():
+    # Staging dirs left behind by a crash are never published or evicted.
+    # Only remove ones nothing has written to for a while, in case another
+    # worker process is still filling them.
+    cutoff = time.time() - STALE_PART_SECONDS
+    for item in os.scandir(CACHE_DIR):
+        if not item.is_dir() or not item.name.endswith(".part"):
+            continue
+        mtimes = [item.stat().st_mtime]
+        mtimes += [f.stat().st_mtime for f in os.scandir(item.path)]
+        if max(mtimes) < cutoff:
+            shutil.rmtree(item.path, ignore_errors=True)
+
+
+CACHE_DIR = prepare_cache_dir()
+remove_stale_parts()
+
+# The page has no template placeholders, so it is read once as plain bytes
+# rather than rendered through Jinja.
+with open(os.path.join(app.root_path, "templates", "index.html"), "rb") as f:
+    _INDEX_HTML = f.read()
+_INDEX_GZ = gzip.compress(_INDEX_HTML, compresslevel=9)
+_INDEX_ETAG = hashlib.md5(_INDEX_HTML).hexdigest()
+_INDEX_GZ_ETAG = hashlib.md5(_INDEX_GZ).hexdigest()
+
 
-HTML_PAGE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>YT Downloader</title>
-</head>
-<body>
-    <h2>YouTube Downloader (MP3 / MP4)</h2>
-    <form method="POST">
-        <input type="text" name="url" placeholder="Enter YouTube URL" size="50" required><br><br>
-
-        <label>Select Format:</label>
-        <select name="format">
-            <option value="mp4">MP4 (Video)</option>
-            <option value="mp3">MP3 (Audio)</option>
-        </select><br><br>
-
-        <label>Video Quality (MP4 only):</label>
-        <select name="quality">
-            <option value="best">Best</option>
-            <option value="720">720p</option>
-            <option value="480">480p</option>
-            <option value="360">360p</option>
-        </select><br><br>
-
-        <button type="submit">Download</button>
-    </form>
-</body>
-</html>
-"""
-
-
-def download_with_options(url, fmt, quality):
-    temp_dir = tempfile.mkdtemp()
-    output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
-
-    extractor_settings = {
-        "youtubetab": {"skip": ["webpage"]},
-        "youtube": {
-            "player_skip": ["webpage", "configs"],
-            "visitor_data": ["Cgtsd3ZzSU1XRlUtbyjv4biBCg=="],
-            "client": ["android", "web"],
-        }
+EXTRACTOR_SETTINGS = {
+    "youtubetab": {"skip": ["webpage"]},
+    "youtube": {
+        "player_skip": ["webpage", "configs"],
+        "visitor_data": ["Cgtsd3ZzSU1XRlUtbyjv4biBCg=="],
+        "client": ["android", "web"],
     }
+}
+
+
+_YT_RE = re.compile(
+    r"^https?://(?:www\.|m\.|music\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/)|youtu\.be/)"
+    r"([A-Za-z0-9_-]{11})(?![\w-])"
+)
+_YT_PLAYLIST_RE = re.compile(
+    r"^https?://(?:www\.|m\.|music\.)?youtube\.com/playlist\?(?:[^#]*&)?list=([A-Za-z0-9_-]+)(?![\w-])"
+)
+
+
+def video_id(url):
+    match = _YT_RE.match(url)
+    return match.group(1) if match else None
+
+
+def parse_download_form():
+    url = request.form.get('url', '').strip()
+    fmt = request.form.get('format', 'mp4')
+    quality = request.form.get('quality', 'best')
+    # Reject anything yt-dlp would only fail on after DNS, HTTP and a full
+    # extractor dispatch; playlists have no v= and are rejected here too.
+    if video_id(url) is None:
+        abort(400, "Not a YouTube video URL")
+    check_format(fmt, quality)
+    return url, fmt, quality
+
+
+def check_format(fmt, quality):
+    if fmt not in MIMETYPES or not (quality == "best" or re.fullmatch(r"[0-9]{1,4}", quality)):
+        abort(400, "Unsupported format or quality")
+
+
+DOWNLOAD_OPTS = {
+    "concurrent_fragment_downloads": 8,
+    "http_chunk_size": 10 * 1024 * 1024,
+    "retries": 3,
+    "fragment_retries": 10,
+    "file_access_retries": 3,
+}
+FFMPEG_INPUT_OPTS = [
+    "-reconnect", "1",
+    "-reconnect_streamed", "1",
+    "-reconnect_on_network_error", "1",
+    "-reconnect_delay_max", "5",
+]
+
+# Read-only option profiles. YoutubeDL keeps and writes into the dict it is
+# given, so every instance gets its own copy of one of these.
+_BASE_OPTS = MappingProxyType({
+    "quiet": True,
+    "no_warnings": True,
+    "noplaylist": True,
+    "check_formats": False,
+    "extractor_args": EXTRACTOR_SETTINGS,
+})
+PROBE_OPTS = MappingProxyType({
+    **_BASE_OPTS,
+    "skip_download": True,
+    "extract_flat": False,
+})
+PLAYLIST_OPTS = MappingProxyType({
+    **_BASE_OPTS,
+    "skip_download": True,
+    "extract_flat": "in_playlist",
+})
+# LAME VBR (-q:a 2) skips the CBR bit-allocation loop; Opus and Vorbis
+# encode faster still at comparable size and quality.
+AUDIO_CODECS = {
+    "mp3": {"preferredcodec": "mp3", "preferredquality": "2"},
+    "opus": {"preferredcodec": "opus", "preferredquality": "128"},
+    "ogg": {"preferredcodec": "vorbis", "preferredquality": "5"},
+}
+FFMPEG_AUDIO_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-q:a", "2", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-b:a", "128k", "-vbr", "on", "-f", "ogg"],
+    "ogg": ["-c:a", "libvorbis", "-q:a", "5", "-f", "ogg"],
+}
+AUDIO_OPTS = MappingProxyType({
+    **_BASE_OPTS,
+    **DOWNLOAD_OPTS,
+    "format": "bestaudio/best",
+})
+MP4_OPTS = MappingProxyType({
+    **_BASE_OPTS,
+    **DOWNLOAD_OPTS,
+    "merge_output_format": "mp4",
+    # The merge is a stream copy; faststart moves the moov atom to the head
+    # of the file so /file/<id> can be played while it is still arriving.
+    "postprocessor_args": {"merger": ["-movflags", "+faststart"]},
+})
+# Extraction is network-bound and takes seconds, so misses get a small pool
+# of warm probe instances rather than queueing behind a single lock.
+_probe_pool = queue.Queue()
+for _ in range(PROBE_POOL_SIZE):
+    _probe_pool.put(yt_dlp.YoutubeDL(dict(PROBE_OPTS)))
+_YDL_AUDIO = yt_dlp.YoutubeDL(dict(AUDIO_OPTS))
+_YDL_MP4 = yt_dlp.YoutubeDL(dict(MP4_OPTS))
+_ydl_locks = {
+    _YDL_AUDIO: threading.Lock(),
+    _YDL_MP4: threading.Lock(),
+}
 
-    if fmt == "mp3":
-        ydl_opts = {
-            "format": "bestaudio/best",
-            "outtmpl": output_template,
-            "postprocessors": [{
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }],
-            "extractor_args": extractor_settings,
-        }
-
-    else:  # MP4
-        if quality == "best":
-            fmt_str = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4"
-        else:
-            fmt_str = f"bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/mp4"
 
-        ydl_opts = {
-            "format": fmt_str,
-            "outtmpl": output_template,
-            "merge_output_format": "mp4",
-            "extractor_args": extractor_settings,
-        }
+def _get_info(url):
+    key = video_id(url)
+    with _info_cache_lock:
+        info = _info_cache.get(key)
+    if info is None:
+        # Extract the canonical URL so tracking params and list= never reach
+        # yt-dlp and every variant of the link shares one cache entry.
+        ydl = _probe_pool.get()
+        try:
+            info = ydl.extract_info(
+                f"https://www.youtube.com/watch?v={key}", download=False, process=False
+            )
+        finally:
+            _probe_pool.put(ydl)
+        with _info_cache_lock:
+            _info_cache[key] = info
+    return info
 
+
+def playlist_urls(list_id, limit):
+    # A throwaway instance per call: playlistend stops the flat extraction
+    # paging further than the batch cap, and nothing is shared to lock.
+    with yt_dlp.YoutubeDL({**PLAYLIST_OPTS, "playlistend": limit}) as ydl:
+        info = ydl.extract_info(
+            f"https://www.youtube.com/playlist?list={list_id}", download=False
+        )
+    return [
+        f"https://www.youtube.com/watch?v={entry['id']}"
+        for entry in info.get("entries") or ()
+        if entry and entry.get("id")
+    ]
+
+
+def format_selector(fmt, quality):
+    if fmt in AUDIO_CODECS:
+        return "bestaudio/best"
+    if quality == "best":
+        return "bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4"
+    return f"bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/mp4"
+
+
+def resolve_formats(url, fmt, quality, info=None):
+    if info is None:
+        info = _get_info(url)
+
+    ydl = _YDL_AUDIO if fmt in AUDIO_CODECS else _YDL_MP4
+    # YoutubeDL compiles params["format"] once in __init__, so the shared
+    # instance needs its selector swapped in directly. Format selection also
+    # mutates the dict, so keep the cached copy pristine.
+    with _ydl_locks[ydl]:
+        ydl.format_selector = ydl.build_format_selector(format_selector(fmt, quality))
+        info = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    return info, info.get("requested_formats") or [info]
+
+
+def download_to_file(url, fmt, quality, dest_dir):
+    info = _get_info(url)
+    ydl_opts = {
+        **(AUDIO_OPTS if fmt in AUDIO_CODECS else MP4_OPTS),
+        "format": format_selector(fmt, quality),
+        "outtmpl": os.path.join(dest_dir, "%(title)s.%(ext)s"),
+    }
+    if fmt in AUDIO_CODECS:
+        ydl_opts["postprocessors"] = [{"key": "FFmpegExtractAudio", **AUDIO_CODECS[fmt]}]
+
+    # Jobs run concurrently, so each one gets its own YoutubeDL rather than
+    # holding a shared profile's lock for the whole transfer.
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filepath = ydl.prepare_filename(info)
-        return filepath
+        info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+    return info["requested_downloads"][0]["filepath"]
+
+
+def cache_key(url, fmt, quality):
+    # Resolution only matters for video; every audio request shares an entry.
+    resolution = quality if fmt == "mp4" else None
+    return hashlib.blake2b(
+        f"{video_id(url)}|{fmt}|{resolution}".encode(), digest_size=16
+    ).hexdigest()
+
+
+def cached_file(key):
+    entry = os.path.join(CACHE_DIR, key)
+    try:
+        names = os.listdir(entry)
+        os.utime(entry)
+    except FileNotFoundError:
+        return None
+    return os.path.join(entry, names[0]) if names else None
+
+
+def new_part_dir(key):
+    # Staging inside CACHE_DIR keeps publish() a same-filesystem rename.
+    return tempfile.mkdtemp(prefix=key, suffix=".part", dir=CACHE_DIR)
+
+
+def publish(key, part, name):
+    for other in os.listdir(part):
+        if other != name:
+            os.remove(os.path.join(part, other))
+    entry = os.path.join(CACHE_DIR, key)
+    try:
+        os.rename(part, entry)
+    except OSError:
+        # Another download published the same key first.
+        shutil.rmtree(part, ignore_errors=True)
+        return cached_file(key)
+    evict_cache(keep=key)
+    return os.path.join(entry, name)
+
+
+def evict_cache(keep=None):
+    with _cache_lock:
+        entries = []
+        for item in os.scandir(CACHE_DIR):
+            if not item.is_dir() or item.name.endswith(".part"):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(item.path))
+            entries.append((item.stat().st_mtime, size, item.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= CACHE_MAX_BYTES:
+                break
+            # Never evict the entry that was just published, even when it is
+            # bigger than the whole cap on its own.
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def submit_download(url, fmt, quality):
+    key = cache_key(url, fmt, quality)
+    path = cached_file(key)
+    # Identical concurrent requests share one download (singleflight).
+    with _jobs_lock:
+        job = _inflight.get(key)
+        if job is None:
+            if path is not None:
+                job = Future()
+                job.set_result(path)
+            else:
+                job = _inflight[key] = EXECUTOR.submit(run_job, key, url, fmt, quality)
+    return job
+
+
+def run_job(key, url, fmt, quality):
+    part = new_part_dir(key)
+    try:
+        path = download_to_file(url, fmt, quality, part)
+        return publish(key, part, os.path.basename(path))
+    except Exception:
+        shutil.rmtree(part, ignore_errors=True)
+        raise
+    finally:
+        # Once the file is cached (or the job failed) later requests go to
+        # the cache or start a fresh download instead of joining this one.
+        with _jobs_lock:
+            del _inflight[key]
+
+
+def chunk_size(f):
+    if f.get("protocol") not in ("http", "https"):
+        return None
+    return (f.get("downloader_options") or {}).get("http_chunk_size")
+
+
+class RangeFeeder(threading.Thread):
+    """Copies one format into a pipe using http_chunk_size Range requests.
+
+    googlevideo throttles a single full-length GET to about playback speed,
+    which is what ffmpeg opens when it is handed the URL itself.
+    """
+
+    def __init__(self, f, fd):
+        super().__init__(daemon=True)
+        self.format = f
+        self.fd = fd
+        self.error = None
+
+    def run(self):
+        try:
+            with os.fdopen(self.fd, "wb") as out, requests.Session() as session:
+                session.headers.update(self.format.get("http_headers") or {})
+                self.copy(session, out)
+        except BrokenPipeError:
+            pass  # ffmpeg is gone: it failed or the client disconnected
+        except Exception as e:
+            self.error = e
+
+    def copy(self, session, out):
+        size = chunk_size(self.format)
+        start, total = 0, None
+        # Like yt-dlp's own retries, the budget is per request, not per file.
+        retries = DOWNLOAD_OPTS["retries"]
+        while total is None or start < total:
+            headers = {"Range": f"bytes={start}-{start + size - 1}"}
+            received = 0
+            try:
+                with session.get(self.format["url"], headers=headers, stream=True, timeout=30) as resp:
+                    if resp.status_code == 416:
+                        return
+                    resp.raise_for_status()
+                    if resp.status_code == 200 and start > 0:
+                        # Range was ignored on a resumed request: the body
+                        # starts over, after bytes ffmpeg already has.
+                        raise RuntimeError("Server ignored the Range header when resuming")
+                    length = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                    total = int(length) if length.isdigit() else total
+                    for block in resp.iter_content(CHUNK_SIZE):
+                        out.write(block)
+                        received += len(block)
+                        start += len(block)
+            except requests.RequestException:
+                retries -= 1
+                if retries < 0:
+                    raise
+                continue
+            retries = DOWNLOAD_OPTS["retries"]
+            # A 200 means Range was ignored and the whole body was sent.
+            if resp.status_code == 200 or (total is None and received < size):
+                return
+
+
+def build_ffmpeg_command(formats, fmt, fds=None):
+    fds = fds or {}
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    for i, f in enumerate(formats):
+        if i in fds:
+            cmd += ["-i", f"pipe:{fds[i]}"]
+            continue
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (f.get("http_headers") or {}).items())
+        if headers:
+            cmd += ["-headers", headers]
+        if f.get("protocol", "").startswith("http"):
+            cmd += FFMPEG_INPUT_OPTS
+        cmd += ["-i", f["url"]]
+
+    if fmt == "opus" and formats[0].get("acodec") == "opus":
+        cmd += ["-vn", "-c:a", "copy", "-f", "ogg"]
+    elif fmt in FFMPEG_AUDIO_ARGS:
+        cmd += ["-vn", *FFMPEG_AUDIO_ARGS[fmt]]
+    else:
+        for i in range(len(formats)):
+            cmd += ["-map", str(i)]
+        # A pipe is not seekable, so the moov atom cannot be moved to the
+        # head afterwards (+faststart); fragmented MP4 starts with an empty
+        # moov instead and is just as playable while it is still arriving.
+        cmd += ["-c", "copy", "-movflags", "frag_keyframe+empty_moov", "-f", "mp4"]
+    cmd.append("pipe:1")
+    return cmd
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink that lets zipfile write straight into a response."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def unique_name(name, taken):
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while name in taken:
+        name = f"{stem} ({n}){ext}"
+        n += 1
+    return name
+
+
+def stream_batch(urls, fmt, quality):
+    sink = _ZipStream()
+    names = set()
+    errors = []
+    todo = list(reversed(urls))
+    pending = {}
+
+    # ZIP_STORED because mp4/mp3/ogg are already compressed.
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+        while todo or pending:
+            while todo and len(pending) < BATCH_CONCURRENCY:
+                url = todo.pop()
+                pending[submit_download(url, fmt, quality)] = url
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for job in done:
+                url = pending.pop(job)
+                if job.exception() is not None:
+                    errors.append(f"{url}: {job.exception()}")
+                    continue
+                path = job.result()
+                name = unique_name(os.path.basename(path), names)
+                names.add(name)
+                try:
+                    src = open(path, "rb")
+                except FileNotFoundError:
+                    errors.append(f"{url}: evicted from cache before it was sent")
+                    continue
+                with src, zf.open(name, "w", force_zip64=True) as dest:
+                    while chunk := src.read(CHUNK_SIZE):
+                        dest.write(chunk)
+                        yield sink.drain()
+        if errors:
+            zf.writestr("ERRORS.txt", "\n".join(errors) + "\n")
+    yield sink.drain()
+
+
+def start_ffmpeg(formats, fmt):
+    fds, feeders = {}, []
+    for i, f in enumerate(formats):
+        if chunk_size(f):
+            read_fd, write_fd = os.pipe()
+            fds[i] = read_fd
+            feeders.append(RangeFeeder(f, write_fd))
+    try:
+        proc = subprocess.Popen(
+            build_ffmpeg_command(formats, fmt, fds),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            bufsize=1 << 20,
+            pass_fds=tuple(fds.values()),
+        )
+    except OSError:
+        for feeder in feeders:
+            os.close(feeder.fd)
+        raise
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+    for feeder in feeders:
+        feeder.start()
+    return proc, feeders
+
+
+def stream_process(proc, feeders, first):
+    try:
+        chunk = first
+        while chunk:
+            yield chunk
+            chunk = proc.stdout.read(CHUNK_SIZE)
+        # Raising aborts the chunked response, so a failed or truncated
+        # transfer never reaches the client looking like a complete file.
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with status {proc.returncode}")
+        for feeder in feeders:
+            feeder.join()
+            if feeder.error is not None:
+                raise feeder.error
+    finally:
+        stop_ffmpeg(proc)
+
+
+def stop_ffmpeg(proc):
+    # Killing ffmpeg also closes the feeders' pipes, so their threads exit
+    # on the next write.
+    proc.stdout.close()
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+
+def tee_to_cache(chunks, key, name):
+    """Pass chunks through while writing them to a staging file in CACHE_DIR.
+
+    The file is published only if the stream runs to the end without an
+    error, so a disconnect or a failed ffmpeg never leaves a partial entry.
+    Caching is best effort: if the staging file cannot be created or
+    written (e.g. a full disk), the chunks are still passed through.
+    """
+    part = out = None
+    try:
+        try:
+            part = new_part_dir(key)
+            # Unbuffered, so a failed write surfaces here and close() has
+            # nothing left to flush.
+            out = open(os.path.join(part, name), "wb", buffering=0)
+        except OSError:
+            pass
+        for chunk in chunks:
+            if out is not None:
+                try:
+                    if out.write(chunk) != len(chunk):
+                        raise OSError("short write to the cache")
+                except OSError:
+                    out.close()
+                    out = None
+            yield chunk
+        if out is not None:
+            out.close()
+            out = None
+            publish(key, part, name)
+            part = None
+    finally:
+        chunks.close()
+        if out is not None:
+            out.close()
+        if part is not None:
+            shutil.rmtree(part, ignore_errors=True)
+
+
+def send_cached(path):
+    if X_ACCEL_PREFIX:
+        location = X_ACCEL_PREFIX.rstrip("/") + "/" + quote(os.path.relpath(path, CACHE_DIR))
+        return Response(
+            mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+            headers={
+                "X-Accel-Redirect": location,
+                "Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}",
+                "Accept-Ranges": "bytes",
+            },
+        )
+    # Without a front end, the WSGI server's wsgi.file_wrapper gets the file
+    # and may sendfile(2) it itself (e.g. gunicorn).
+    return send_file(
+        path,
+        as_attachment=True,
+        conditional=True,
+        etag=True,
+        last_modified=os.path.getmtime(path),
+    )
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        url = request.form['url']
-        fmt = request.form['format']
-        quality = request.form.get('quality', 'best')
+        url, fmt, quality = parse_download_form()
+
+        key = cache_key(url, fmt, quality)
+        path = cached_file(key)
+        if path is not None:
+            try:
+                return send_cached(path)
+            except FileNotFoundError:
+                pass  # evicted since the lookup; fall through to a download
+
+        info, formats = resolve_formats(url, fmt, quality)
+        proc, feeders = start_ffmpeg(formats, fmt)
+        # Read ahead so a failure to start (403, bad input) is still a 502.
+        first = proc.stdout.read(CHUNK_SIZE)
+        if not first:
+            stop_ffmpeg(proc)
+            abort(502, "Could not fetch the media stream")
+        filename = f"{yt_dlp.utils.sanitize_filename(info['title'])}.{fmt}"
+        response = Response(
+            stream_with_context(tee_to_cache(stream_process(proc, feeders, first), key, filename)),
+            mimetype=MIMETYPES[fmt],
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"},
+        )
+        # Closing a generator that never started runs none of its cleanup,
+        # so a response dropped before the first chunk must stop ffmpeg here.
+        response.call_on_close(lambda: stop_ffmpeg(proc))
+        return response
+
+    if request.accept_encodings["gzip"]:
+        response = Response(_INDEX_GZ, mimetype="text/html")
+        response.content_encoding = "gzip"
+        response.set_etag(_INDEX_GZ_ETAG)
+    else:
+        response = Response(_INDEX_HTML, mimetype="text/html")
+        response.set_etag(_INDEX_ETAG)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
 
-        filepath = download_with_options(url, fmt, quality)
-        return send_file(filepath, as_attachment=True)
+@app.route('/download', methods=['POST'])
+def download():
+    url, fmt, quality = parse_download_form()
 
-    return render_template_string(HTML_PAGE)
+    job = submit_download(url, fmt, quality)
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        JOBS[job_id] = job
+    return {"job_id": job_id}, 202
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        abort(400, "Expected a JSON object")
+    fmt = data.get("format", "mp4")
+    quality = data.get("quality", "best")
+    if isinstance(quality, int) and not isinstance(quality, bool):
+        quality = str(quality)
+    if not (isinstance(fmt, str) and isinstance(quality, str)):
+        abort(400, "Unsupported format or quality")
+    check_format(fmt, quality)
+    given = data.get("urls") or []
+    if not isinstance(given, list) or not all(isinstance(url, str) for url in given):
+        abort(400, "urls must be a list of strings")
+
+    urls = []
+    for url in given:
+        url = url.strip()
+        match = _YT_PLAYLIST_RE.match(url)
+        if match:
+            # One past the cap is enough to tell the batch is too big.
+            try:
+                urls += playlist_urls(match.group(1), BATCH_MAX_URLS + 1 - len(urls))
+            except yt_dlp.utils.DownloadError:
+                abort(400, f"Could not read playlist: {url}")
+        elif video_id(url) is not None:
+            urls.append(url)
+        else:
+            abort(400, f"Not a YouTube video or playlist URL: {url}")
+        if len(urls) > BATCH_MAX_URLS:
+            abort(400, f"At most {BATCH_MAX_URLS} videos per batch")
+    if not urls:
+        abort(400, "No URLs given")
+    # The same video listed twice (or in a playlist as well) is sent once.
+    unique = {}
+    for url in urls:
+        unique.setdefault(video_id(url), url)
+    urls = list(unique.values())
+
+    return Response(
+        stream_batch(urls, fmt, quality),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=batch.zip"},
+    )
+
+
+@app.route('/status/<job_id>')
+def status(job_id):
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    if not job.done():
+        return {"status": "running"}
+    if job.exception() is not None:
+        return {"status": "error", "error": str(job.exception())}
+    return {"status": "done"}
+
+
+@app.route('/file/<job_id>')
+def job_file(job_id):
+    with _jobs_lock:
+        job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    if not job.done():
+        abort(409)
+    if job.exception() is not None:
+        abort(500)
+    try:
+        return send_cached(job.result())
+    except FileNotFoundError:
+        # Evicted from the cache since the job finished.
+        abort(410)
+
+
+@app.after_request
+def advertise_ranges(response):
+    # send_file(conditional=True) already answers Range requests with 206 and
+    # sets "Accept-Ranges: bytes"; anything else is generated on the fly.
+    response.headers.setdefault("Accept-Ranges", "none")
+    return response
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    from waitress import serve
+
+    serve(
+        app,
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', 3000)),
+        threads=16,
+        channel_timeout=3600,
+        asyncore_use_poll=True,
+    )
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp())
+
+import app  # noqa: E402
+
+
+def _format(format_id, ext, height=None, vcodec="none", acodec="none"):
+    return {
+        "format_id": format_id,
+        "url": f"https://example.invalid/{format_id}",
+        "protocol": "https",
+        "ext": ext,
+        "height": height,
+        "vcodec": vcodec,
+        "acodec": acodec,
+    }
+
+
+INFO = {
+    "id": "dQw4w9WgXcQ",
+    "title": "Stub",
+    "extractor": "youtube",
+    "extractor_key": "Youtube",
+    "webpage_url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "formats": [
+        _format("140", "m4a", acodec="mp4a.40.2"),
+        _format("251", "webm", acodec="opus"),
+        _format("136", "mp4", height=720, vcodec="avc1.4d401f"),
+        _format("137", "mp4", height=1080, vcodec="avc1.640028"),
+    ],
+}
+
+
+def selected(fmt, quality):
+    _, formats = app.resolve_formats(INFO["webpage_url"], fmt, quality, info=INFO)
+    return [f["format_id"] for f in formats]
+
+
+class ResolveFormatsTest(unittest.TestCase):
+    def test_mp4_best_picks_mp4_video_and_m4a_audio(self):
+        self.assertEqual(selected("mp4", "best"), ["137", "140"])
+
+    def test_mp4_quality_caps_the_height(self):
+        self.assertEqual(selected("mp4", "720"), ["136", "140"])
+
+    def test_mp4_quality_applies_after_another_quality(self):
+        # The shared instance must not keep the previous request's selector.
+        selected("mp4", "best")
+        self.assertEqual(selected("mp4", "720"), ["136", "140"])
+
+    def test_audio_picks_best_audio_only(self):
+        (format_id,) = selected("mp3", "best")
+        self.assertIn(format_id, ("140", "251"))
+
+    def test_cached_info_is_not_mutated(self):
+        selected("mp4", "720")
+        self.assertNotIn("requested_formats", INFO)
+
+
+if __name__ == "__main__":
+    unittest.main()